@@ -6,8 +6,9 @@ from mailer.models import DontSendEntry, Message, MessageLog
 
 
 def show_to(message):
-    if message.email:
-        return ", ".join(message.to_addresses)
+    email = message.email
+    if email:
+        return ", ".join(email.to)
     else:
         return "<Message data unavailable>"
 
@@ -16,8 +17,9 @@ show_to.short_description = "To"  # noqa: E305
 
 
 def show_subject(message):
-    if message.email:
-        return message.subject
+    email = message.email
+    if email:
+        return email.subject
     else:
         return "<Message data unavailable>"
 
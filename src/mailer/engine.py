@@ -39,10 +39,12 @@ logger = logging.getLogger(__name__)
 def prioritize(queryset=None):
     """
     Returns the messages in the queue in the order they should be sent.
+    The message data is not loaded, as each message is fetched again when
+    it is sent (see sender_context).
     """
-    if queryset:
-        return queryset.order_by("priority", "when_added")
-    return Message.objects.non_deferred().order_by("priority", "when_added")
+    if queryset is None:
+        queryset = Message.objects.non_deferred()
+    return queryset.defer("message_data", "message_data_bin").order_by("priority", "when_added")
 
 
 @contextlib.contextmanager
@@ -63,15 +65,22 @@ def sender_context(message):
     # processes. Otherwise, the losing process has to wait for the winning
     # process to finish and release the lock, and the winning process will
     # almost always win the next message etc.
+
+    # Where supported, `skip_locked` does the same without raising an error:
+    # a message locked by someone else simply isn't found.
+    if transaction.get_connection().features.has_select_for_update_skip_locked:
+        lock_kwargs = {"skip_locked": True}
+    else:
+        lock_kwargs = {"nowait": True}
     with transaction.atomic():
         try:
             try:
-                yield Message.objects.filter(id=message.id).select_for_update(nowait=True).get()
+                yield Message.objects.filter(id=message.id).select_for_update(**lock_kwargs).get()
             except NotSupportedFeatureException:
                 # MySQL
                 yield Message.objects.filter(id=message.id).select_for_update().get()
         except Message.DoesNotExist:
-            # Deleted by someone else
+            # Deleted (or, with `skip_locked`, locked) by someone else
             yield None
         except OperationalError:
             # Locked by someone else
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-14 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0007_alter_messagelog_message_data"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="message_data_bin",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name="messagelog",
+            name="message_data_bin",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="message_data",
+            field=models.TextField(blank=True),
+        ),
+    ]
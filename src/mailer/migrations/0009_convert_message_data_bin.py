@@ -0,0 +1,90 @@
+import base64
+import binascii
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def text_to_pickle(text):
+    # Rows hold either a base64 encoded pickle, or (for very old rows) the raw
+    # pickle itself. A pickle always ends with the STOP opcode ".", which is
+    # not part of the base64 alphabet.
+    data = text.encode("ascii")
+    if data.endswith(b"."):
+        return data
+    return base64.decodebytes(data)
+
+
+def convert_rows(queryset, empty_value):
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by("pk").only("pk", "message_data")[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        converted = []
+        for obj in batch:
+            try:
+                obj.message_data_bin = text_to_pickle(obj.message_data)
+            except (UnicodeEncodeError, binascii.Error):
+                # Leave undecodable rows as they are, message_data is still
+                # used as a fallback.
+                continue
+            obj.message_data = empty_value
+            converted.append(obj)
+        queryset.model._base_manager.db_manager(queryset.db).bulk_update(
+            converted, ["message_data", "message_data_bin"]
+        )
+
+
+def pickle_to_text(queryset):
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by("pk").only("pk", "message_data_bin")[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for obj in batch:
+            obj.message_data = base64.encodebytes(bytes(obj.message_data_bin)).decode("ascii")
+            obj.message_data_bin = None
+        queryset.model._base_manager.db_manager(queryset.db).bulk_update(batch, ["message_data", "message_data_bin"])
+
+
+def forwards(apps, schema_editor):
+    Message = apps.get_model("mailer", "Message")
+    MessageLog = apps.get_model("mailer", "MessageLog")
+    db_alias = schema_editor.connection.alias
+
+    convert_rows(
+        Message._base_manager.using(db_alias).filter(message_data_bin__isnull=True).exclude(message_data=""), ""
+    )
+    convert_rows(
+        MessageLog._base_manager.using(db_alias)
+        .filter(message_data_bin__isnull=True, message_data__isnull=False)
+        .exclude(message_data=""),
+        None,
+    )
+
+
+def backwards(apps, schema_editor):
+    Message = apps.get_model("mailer", "Message")
+    MessageLog = apps.get_model("mailer", "MessageLog")
+    db_alias = schema_editor.connection.alias
+
+    pickle_to_text(Message._base_manager.using(db_alias).filter(message_data_bin__isnull=False))
+    pickle_to_text(MessageLog._base_manager.using(db_alias).filter(message_data_bin__isnull=False))
+
+
+class Migration(migrations.Migration):
+    # Commit each batch separately, rather than converting the whole of the
+    # (possibly huge) MessageLog table in one transaction.
+    atomic = False
+
+    dependencies = [
+        ("mailer", "0008_message_data_bin"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
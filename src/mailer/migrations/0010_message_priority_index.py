@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-14 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0009_convert_message_data_bin"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["priority", "when_added"], name="mailer_message_priority_idx"),
+        ),
+    ]
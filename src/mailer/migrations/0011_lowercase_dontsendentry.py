@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-14 19:31
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def lowercase_to_address(apps, schema_editor):
+    DontSendEntry = apps.get_model("mailer", "DontSendEntry")
+    db_alias = schema_editor.connection.alias
+    DontSendEntry._base_manager.using(db_alias).update(to_address=Lower("to_address"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0010_message_priority_index"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="dontsendentry",
+            name="to_address",
+            field=models.EmailField(db_index=True, max_length=254),
+        ),
+        migrations.RunPython(lowercase_to_address, migrations.RunPython.noop),
+    ]
@@ -4,8 +4,10 @@ import logging
 import pickle
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import EmailMessage
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.utils.timezone import now as datetime_now
 from django.utils.translation import gettext_lazy as _
 
@@ -23,6 +25,11 @@ PRIORITIES = [
 
 PRIORITY_MAPPING = dict((label, v) for (v, label) in PRIORITIES)
 
+DONT_SEND_CACHE_KEY = "mailer:dontsend"
+# recipient lists longer than this are checked against the don't send list in
+# the database, instead of using the cached list.
+DONT_SEND_QUERY_THRESHOLD = 100
+
 logger = logging.getLogger(__name__)
 
 
@@ -36,12 +43,74 @@ class BigAutoModel(models.Model):
         abstract = True
 
 
+def _has_delete_signals(model):
+    return pre_delete.has_listeners(model) or post_delete.has_listeners(model)
+
+
+def _fast_delete(qs):
+    """
+    delete everything in the given queryset with a single DELETE statement,
+    returning the number of rows deleted
+    """
+    # Nothing points at the mailer models, so the deletion collector is pure
+    # overhead - unless someone is listening for the delete signals.
+    if _has_delete_signals(qs.model):
+        return qs.delete()[0]
+    return qs._raw_delete(qs.db)
+
+
+def _chunked_pks(qs, chunk=1000):
+    """
+    yield the primary keys of the given queryset in lists of up to `chunk`
+    """
+    # Keys are read in primary key order, so that rows which still match the
+    # queryset after being processed don't come up again.
+    qs = qs.order_by("pk").values_list("pk", flat=True)
+    if connections[qs.db].vendor == "sqlite":
+        # SQLite doesn't isolate an open cursor from writes to the same table
+        # on the same connection, and the caller writes between batches, so
+        # page through the primary key index with one query per batch.
+        ids = list(qs[:chunk])
+        while ids:
+            yield ids
+            ids = list(qs.filter(pk__gt=ids[-1])[:chunk])
+        return
+    # Elsewhere, stream the keys from a single query, so that memory use stays
+    # bounded and the table is only scanned once. On PostgreSQL, iterator()
+    # uses a server-side cursor unless DISABLE_SERVER_SIDE_CURSORS is set.
+    ids = []
+    for pk in qs.iterator(chunk_size=chunk):
+        ids.append(pk)
+        if len(ids) == chunk:
+            yield ids
+            ids = []
+    if ids:
+        yield ids
+
+
+def _chunked_delete(qs, chunk=None):
+    """
+    delete everything in the given queryset in batches of `chunk` rows,
+    returning the total number of rows deleted
+    """
+    # Deleting a huge backlog in one statement holds locks for a long time,
+    # so keep each DELETE (and its transaction) bounded.
+    if chunk is None:
+        chunk = getattr(settings, "MAILER_PURGE_BATCH_SIZE", 1000)
+    # Apply the original filter again for each batch, so that rows changed
+    # since their keys were read (e.g. a retried message) are left alone.
+    return sum(_fast_delete(qs.filter(pk__in=ids)) for ids in _chunked_pks(qs, chunk))
+
+
 def get_message_id(msg):
+    headers = msg.extra_headers
+    # "Message-ID" is the spelling used by Django and by ensure_message_id(),
+    # so try a plain dict lookup first.
+    if "Message-ID" in headers:
+        return headers["Message-ID"]
     # From django.core.mail.message: Email header names are case-insensitive
     # (RFC 2045), so we have to accommodate that when doing comparisons.
-    for key, value in msg.extra_headers.items():
-        if key.lower() == "message-id":
-            return value
+    return next((value for key, value in headers.items() if key.lower() == "message-id"), None)
 
 
 class MessageManager(models.Manager):
@@ -75,48 +144,82 @@ class MessageManager(models.Manager):
         """
         return self.filter(priority=PRIORITY_DEFERRED)
 
+    def lock_next(self, batch=100):
+        """
+        lock and return the next `batch` messages in the queue, in the order
+        they should be sent, skipping any messages locked by another worker.
+
+        This must be called inside transaction.atomic(), and the messages
+        should be sent and deleted (or deferred) in that same transaction, as
+        the locks are released when it ends.
+        """
+        return list(self._lock_next_queryset(batch))
+
+    def _lock_next_queryset(self, batch=100):
+        """
+        the unevaluated queryset used by lock_next()
+        """
+        queryset = self.non_deferred().select_for_update(skip_locked=True)
+        return queryset.order_by("priority", "when_added")[:batch]
+
     def retry_deferred(self, new_priority=PRIORITY_MEDIUM):
         qs = self.deferred()
         if getattr(settings, "MAILER_EMAIL_MAX_RETRIES", None) is not None:
             qs = qs.filter(retry_count__lt=settings.MAILER_EMAIL_MAX_RETRIES)
-        return qs.update(priority=new_priority, retry_count=models.F("retry_count") + 1)
+        # Update in batches, like purge_deferred(), so that a large number of
+        # deferred messages doesn't mean one huge UPDATE holding row locks.
+        total = 0
+        for ids in _chunked_pks(qs, getattr(settings, "MAILER_RETRY_BATCH_SIZE", 1000)):
+            total += qs.filter(pk__in=ids).update(priority=new_priority, retry_count=models.F("retry_count") + 1)
+        return total
 
     def purge_deferred(self):
-        qs = self.deferred()
-        count = qs.count()
-        qs.delete()
-        return count
-
-
-base64_encode = base64.encodebytes if hasattr(base64, "encodebytes") else base64.encodestring
-base64_decode = base64.decodebytes if hasattr(base64, "decodebytes") else base64.decodestring
+        return _chunked_delete(self.deferred())
 
 
 def email_to_db(email):
-    # pickle.dumps returns essentially binary data which we need to base64
-    # encode to store in a unicode field. finally we encode back to make sure
-    # we only try to insert unicode strings into the db, since we use a
-    # TextField
-    return base64_encode(pickle.dumps(email)).decode("ascii")
+    # The raw pickle is stored in a BinaryField, so no further encoding is
+    # needed. Messages pickled with older protocols remain readable, as the
+    # protocol is recorded in the pickle stream itself.
+    return pickle.dumps(email, pickle.HIGHEST_PROTOCOL)
 
 
 def db_to_email(data):
-    if data == "":
+    if not data:
         return None
-    else:
-        try:
+    try:
+        if isinstance(data, str):
             data = data.encode("ascii")
-        except AttributeError:
-            pass
+        # Current rows hold the raw pickle. Older rows hold a base64 encoded
+        # pickle, or even older ones the result of pickle.dumps(val), in a
+        # TextField. A pickle always ends with the STOP opcode ".", which is
+        # not part of the base64 alphabet, so we can tell them apart.
+        if data[-1:] != b".":
+            data = base64.decodebytes(data)
+        return pickle.loads(data)
+    except Exception:
+        return None
 
-        try:
-            return pickle.loads(base64_decode(data))
-        except (TypeError, pickle.UnpicklingError, base64.binascii.Error, AttributeError):
-            try:
-                # previous method was to just do pickle.dumps(val)
-                return pickle.loads(data)
-            except (TypeError, pickle.UnpicklingError, AttributeError):
-                return None
+
+def _stored_message_data(obj):
+    # message_data only holds a value for rows stored before message_data_bin
+    # was added and not (yet) converted by the data migration.
+    if obj.message_data_bin is not None:
+        return obj.message_data_bin
+    return obj.message_data
+
+
+def _get_cached_email(obj):
+    # Decoding is expensive and __str__, to_addresses and subject all need
+    # the email, so cache it keyed on the identity of the stored data. Both
+    # assigning new data and reloading from the DB invalidate the cache.
+    data = _stored_message_data(obj)
+    cached = obj.__dict__.get("_email_cache")
+    if cached is not None and cached[0] is data:
+        return cached[1]
+    email = db_to_email(data)
+    obj.__dict__["_email_cache"] = (data, email)
+    return email
 
 
 class Message(BigAutoModel):
@@ -125,7 +228,9 @@ class Message(BigAutoModel):
     """
 
     # The actual data - a pickled EmailMessage
-    message_data = models.TextField()
+    message_data_bin = models.BinaryField(null=True)
+    # Deprecated: base64 encoded pickle, only read as a fallback for old rows
+    message_data = models.TextField(blank=True)
     when_added = models.DateTimeField(default=datetime_now)
     priority = models.PositiveSmallIntegerField(choices=PRIORITIES, default=PRIORITY_MEDIUM)
     retry_count = models.IntegerField(default=0)
@@ -135,6 +240,11 @@ class Message(BigAutoModel):
     class Meta:
         verbose_name = _("message")
         verbose_name_plural = _("messages")
+        indexes = [
+            # Matches the filtering and ordering of the queue, see
+            # mailer.engine.prioritize()
+            models.Index(fields=["priority", "when_added"], name="mailer_message_priority_idx"),
+        ]
 
     def __str__(self):
         try:
@@ -148,16 +258,19 @@ class Message(BigAutoModel):
         self.save()
 
     def _get_email(self):
-        return db_to_email(self.message_data)
+        return _get_cached_email(self)
 
     def _set_email(self, val):
-        self.message_data = email_to_db(val)
+        self.__dict__.pop("_email_cache", None)
+        self.message_data_bin = email_to_db(val)
+        self.message_data = ""
 
     email = property(
         _get_email,
         _set_email,
-        doc="""EmailMessage object. If this is mutated, you will need to
-set the attribute again to cause the underlying serialised data to be updated.""",
+        doc="""EmailMessage object. The decoded object is cached on the instance,
+so if this is mutated, you will need to set the attribute again to cause the
+underlying serialised data to be updated.""",
     )
 
     @property
@@ -178,12 +291,22 @@ set the attribute again to cause the underlying serialised data to be updated.""
 
 
 def filter_recipient_list(lst):
+    """
+    remove any addresses on the don't send list from the given list
+    """
     if lst is None:
         return None
+    blocked = None
+    if lst and len(lst) <= DONT_SEND_QUERY_THRESHOLD:
+        blocked = DontSendEntry.objects.blocked_set()
+    if blocked is None:
+        # For long recipient lists, or a don't send list too large to cache,
+        # have the database match them against the indexed column instead.
+        blocked = DontSendEntry.objects.blocked_among(e.lower() for e in lst if e is not None)
     retval = []
     for e in lst:
-        if DontSendEntry.objects.has_address(e):
-            logger.info(f"skipping email to {e.encode('utf-8')} as on don't send list ")
+        if e is not None and e.lower() in blocked:
+            logger.info("skipping email to %s as on don't send list", e)
         else:
             retval.append(e)
     return retval
@@ -216,13 +339,49 @@ class DontSendEntryManager(models.Manager):
         """
         is the given address on the don't send list?
         """
-        queryset = self.filter(to_address__iexact=address)
+        if address is None:
+            return False
+        # addresses are stored lowercased, see _lowercase_dont_send_address()
+        queryset = self.filter(to_address=address.lower())
         return queryset.exists()
 
+    def blocked_set(self):
+        """
+        the (lowercased) addresses on the don't send list, cached using the
+        default cache for MAILER_DONT_SEND_CACHE_TIMEOUT seconds, or None if
+        there are more than MAILER_DONT_SEND_CACHE_MAX_ENTRIES of them
+        """
+        blocked = cache.get(DONT_SEND_CACHE_KEY)
+        if blocked is None:
+            # Cache backends limit the size of a value (1 MB by default on
+            # memcached) and may drop larger ones silently, which would mean
+            # reading the whole table every time.
+            limit = getattr(settings, "MAILER_DONT_SEND_CACHE_MAX_ENTRIES", 10000)
+            addresses = list(self.values_list("to_address", flat=True)[: limit + 1])
+            # False marks the list as too large, so that we don't count it again
+            blocked = frozenset(a.lower() for a in addresses) if len(addresses) <= limit else False
+            cache.set(DONT_SEND_CACHE_KEY, blocked, getattr(settings, "MAILER_DONT_SEND_CACHE_TIMEOUT", 300))
+        if blocked is False:
+            return None
+        return blocked
+
+    def blocked_among(self, addresses, chunk=500):
+        """
+        the given (lowercased) addresses which are on the don't send list
+        """
+        addresses = list(addresses)
+        blocked = set()
+        # stay below the limit on query parameters of some databases
+        for i in range(0, len(addresses), chunk):
+            blocked.update(self.filter(to_address__in=addresses[i : i + chunk]).values_list("to_address", flat=True))
+        return blocked
+
 
 class DontSendEntry(BigAutoModel):
 
-    to_address = models.EmailField(max_length=254)
+    # Lowercased on save, so that lookups can use the index. bulk_create() and
+    # update() don't do this, callers using them must lowercase addresses.
+    to_address = models.EmailField(max_length=254, db_index=True)
     when_added = models.DateTimeField()
 
     objects = DontSendEntryManager()
@@ -232,6 +391,24 @@ class DontSendEntry(BigAutoModel):
         verbose_name_plural = _("don't send entries")
 
 
+def _lowercase_dont_send_address(instance, **kwargs):
+    # A signal rather than save(), so that loaddata (raw saves) is covered too
+    if instance.to_address:
+        instance.to_address = instance.to_address.lower()
+
+
+def _invalidate_dont_send_cache(**kwargs):
+    cache.delete(DONT_SEND_CACHE_KEY)
+    # Also clear it once the change is visible to other connections, as they
+    # may have cached the old list in the meantime.
+    transaction.on_commit(lambda: cache.delete(DONT_SEND_CACHE_KEY), using=kwargs.get("using"))
+
+
+pre_save.connect(_lowercase_dont_send_address, sender=DontSendEntry)
+post_save.connect(_invalidate_dont_send_cache, sender=DontSendEntry)
+post_delete.connect(_invalidate_dont_send_cache, sender=DontSendEntry)
+
+
 RESULT_SUCCESS = "1"
 RESULT_DONT_SEND = "2"
 RESULT_FAILURE = "3"
@@ -245,16 +422,16 @@ RESULT_CODES = (
 
 
 class MessageLogManager(models.Manager):
-    def log(self, message, result_code, log_message=""):
-        """
-        create a log entry for an attempt to send the given message and
-        record the given result and (optionally) a log message
-        """
+    def _log_fields(self, message, result_code, log_message=""):
         log_message_data = getattr(settings, "MAILER_EMAIL_LOG_MESSAGE_DATA", True)
-        message_data = message.message_data if log_message_data else None
+        if log_message_data:
+            message_data, message_data_bin = message.message_data, message.message_data_bin
+        else:
+            message_data, message_data_bin = None, None
 
-        return self.create(
+        return dict(
             message_data=message_data,
+            message_data_bin=message_data_bin,
             message_id=get_message_id(message.email),
             when_added=message.when_added,
             priority=message.priority,
@@ -262,15 +439,32 @@ class MessageLogManager(models.Manager):
             log_message=log_message,
         )
 
+    def log(self, message, result_code, log_message=""):
+        """
+        create a log entry for an attempt to send the given message and
+        record the given result and (optionally) a log message
+        """
+        return self.create(**self._log_fields(message, result_code, log_message))
+
+    def log_bulk(self, items, batch_size=500):
+        """
+        create log entries for several attempts at once, like log(). `items`
+        is a sequence of (message, result_code, log_message) tuples.
+        """
+        return self.bulk_create(
+            [
+                self.model(**self._log_fields(message, result_code, log_message))
+                for message, result_code, log_message in items
+            ],
+            batch_size=batch_size,
+        )
+
     def purge_old_entries(self, days, result_codes=None):
         if result_codes is None:
             # retro-compatibility with previous versions
             result_codes = [RESULT_SUCCESS]
         limit = datetime_now() - datetime.timedelta(days=days)
-        query = self.filter(when_attempted__lt=limit, result__in=result_codes)
-        count = query.count()
-        query.delete()
-        return count
+        return _chunked_delete(self.filter(when_attempted__lt=limit, result__in=result_codes))
 
 
 class MessageLog(BigAutoModel):
@@ -280,6 +474,7 @@ class MessageLog(BigAutoModel):
     """
 
     # fields from Message
+    message_data_bin = models.BinaryField(null=True)
     message_data = models.TextField(null=True)
     message_id = models.TextField(editable=False, null=True)
     when_added = models.DateTimeField(db_index=True)
@@ -308,7 +503,7 @@ class MessageLog(BigAutoModel):
 
     @property
     def email(self):
-        return db_to_email(self.message_data)
+        return _get_cached_email(self)
 
     @property
     def to_addresses(self):
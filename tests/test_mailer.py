@@ -1,3 +1,4 @@
+import base64
 import datetime
 import pickle
 import time
@@ -7,12 +8,16 @@ import django
 import lockfile
 import mailer
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
+from django.db import transaction
+from django.db.models.signals import post_delete
 from django.test import TestCase
 from django.utils.timezone import now as datetime_now
 from mailer import engine
 from mailer.models import (
+    DONT_SEND_CACHE_KEY,
     PRIORITY_DEFERRED,
     PRIORITY_HIGH,
     PRIORITY_LOW,
@@ -24,13 +29,23 @@ from mailer.models import (
     MessageLog,
     db_to_email,
     email_to_db,
+    filter_recipient_list,
+    get_message_id,
     make_message,
 )
 
 from . import TestMailerEmailBackend
 
 
-class BackendTest(TestCase):
+class MailerTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        # The don't send list is cached, and rolling back a test doesn't
+        # invalidate it
+        cache.delete(DONT_SEND_CACHE_KEY)
+
+
+class BackendTest(MailerTestCase):
     def test_save_to_db(self):
         """
         Test that using send_mail creates a Message object in DB instead, when EMAIL_BACKEND is set.
@@ -53,8 +68,9 @@ class BackendTest(TestCase):
             self.assertEqual(Message.objects.count(), 2)
 
 
-class SendingTest(TestCase):
+class SendingTest(MailerTestCase):
     def setUp(self):
+        super().setUp()
         # Ensure outbox is empty at start
         del TestMailerEmailBackend.outbox[:]
 
@@ -95,6 +111,21 @@ class SendingTest(TestCase):
             self.assertEqual(Message.objects.count(), 0)
             self.assertEqual(MessageLog.objects.count(), 2)
 
+    def test_retry_deferred_in_batches(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend"):
+            for i in range(5):
+                mailer.send_mail(f"Subject{i}", "Body", "sender@example.com", ["recipient@example.com"])
+            engine.send_all()
+            self.assertEqual(Message.objects.deferred().count(), 5)
+
+            # Use batches of 2; retrying back into the deferred queue must still terminate
+            with self.settings(MAILER_RETRY_BATCH_SIZE=2):
+                self.assertEqual(Message.objects.retry_deferred(new_priority=PRIORITY_DEFERRED), 5)
+                self.assertEqual(Message.objects.retry_deferred(), 5)
+
+            self.assertEqual(Message.objects.deferred().count(), 0)
+            self.assertEqual(list(Message.objects.values_list("retry_count", flat=True)), [2] * 5)
+
     def test_max_retry_deferred(self):
         with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend", MAILER_EMAIL_MAX_RETRIES=2):  # noqa
             mailer.send_mail("Subject", "Body", "sender@examle.com", ["recipient@example.com"])
@@ -324,6 +355,78 @@ class SendingTest(TestCase):
             self.assertEqual(sent.body, "GoBody")
             self.assertEqual(sent.to, ["go@example.com"])
 
+    def test_dont_send_entry_lowercased(self):
+        entry = DontSendEntry.objects.create(to_address="NoGo@Example.com", when_added=datetime_now())
+        entry.refresh_from_db()
+
+        self.assertEqual(entry.to_address, "nogo@example.com")
+        self.assertTrue(DontSendEntry.objects.has_address("NOGO@example.com"))
+        self.assertTrue(DontSendEntry.objects.has_address("nogo@example.com"))
+        self.assertFalse(DontSendEntry.objects.has_address("go@example.com"))
+
+    def test_dont_send_entry_lowercased_on_raw_save(self):
+        now = datetime_now()
+        # raw saves, as done by loaddata, are lowercased too
+        DontSendEntry(to_address="NoGo@Example.com", when_added=now).save_base(raw=True)
+        self.assertEqual(DontSendEntry.objects.get().to_address, "nogo@example.com")
+        self.assertTrue(DontSendEntry.objects.has_address("NoGo@Example.com"))
+
+        recipients = ["go@example.com", "NOGO@example.com", "NoGo@Example.com"]
+        self.assertEqual(filter_recipient_list(recipients), ["go@example.com"])
+        self.assertEqual(filter_recipient_list(recipients * 50), ["go@example.com"] * 50)
+
+    def test_blacklisted_emails_cached(self):
+        now = datetime_now()
+        DontSendEntry.objects.create(to_address="nogo@example.com", when_added=now)
+        entry = DontSendEntry.objects.create(to_address="NoGo2@example.com", when_added=now)
+        recipients = ["go@example.com", "NOGO@example.com", "nogo2@example.com", "alsogo@example.com"]
+
+        with self.assertNumQueries(1), self.assertLogs("mailer.models", "INFO") as logs:
+            self.assertEqual(filter_recipient_list(recipients), ["go@example.com", "alsogo@example.com"])
+        self.assertEqual(
+            logs.output,
+            [
+                "INFO:mailer.models:skipping email to NOGO@example.com as on don't send list",
+                "INFO:mailer.models:skipping email to nogo2@example.com as on don't send list",
+            ],
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(filter_recipient_list(recipients), ["go@example.com", "alsogo@example.com"])
+
+        # Changes to the don't send list invalidate the cache
+        entry.delete()
+        self.assertEqual(
+            filter_recipient_list(recipients), ["go@example.com", "nogo2@example.com", "alsogo@example.com"]
+        )
+        DontSendEntry.objects.create(to_address="alsogo@example.com", when_added=now)
+        self.assertEqual(filter_recipient_list(recipients), ["go@example.com", "nogo2@example.com"])
+
+    def test_blacklisted_emails_too_many_to_cache(self):
+        now = datetime_now()
+        DontSendEntry.objects.create(to_address="nogo@example.com", when_added=now)
+        DontSendEntry.objects.create(to_address="nogo2@example.com", when_added=now)
+        recipients = ["go@example.com", "NOGO@example.com"]
+
+        with self.settings(MAILER_DONT_SEND_CACHE_MAX_ENTRIES=1):
+            self.assertIsNone(DontSendEntry.objects.blocked_set())
+            with self.assertNumQueries(1):
+                self.assertEqual(filter_recipient_list(recipients), ["go@example.com"])
+
+    def test_blacklisted_emails_long_recipient_list(self):
+        now = datetime_now()
+        DontSendEntry.objects.create(to_address="nogo3@example.com", when_added=now)
+        DontSendEntry.objects.create(to_address="nogo700@example.com", when_added=now)
+        DontSendEntry.objects.create(to_address="other@example.com", when_added=now)
+        recipients = [f"NoGo{i}@example.com" for i in range(1000)]
+
+        with patch.object(DontSendEntry.objects, "blocked_set", side_effect=AssertionError):
+            with self.assertNumQueries(2):
+                filtered = filter_recipient_list(recipients)
+
+        self.assertEqual(len(filtered), 998)
+        self.assertNotIn("NoGo3@example.com", filtered)
+        self.assertNotIn("NoGo700@example.com", filtered)
+
     def test_control_max_delivery_amount(self):
         with self.settings(MAILER_EMAIL_BACKEND="tests.TestMailerEmailBackend", MAILER_EMAIL_MAX_BATCH=2):  # noqa
             mailer.send_mail("Subject1", "Body1", "sender1@example.com", ["recipient1@example.com"])
@@ -430,8 +533,9 @@ class SendingTest(TestCase):
             self.assertEqual(m.message_id, "foo")
 
 
-class LockNormalTest(TestCase):
+class LockNormalTest(MailerTestCase):
     def setUp(self):
+        super().setUp()
         class CustomError(Exception):
             pass
 
@@ -456,8 +560,9 @@ class LockNormalTest(TestCase):
         self.patcher_prio.stop()
 
 
-class LockLockedTest(TestCase):
+class LockLockedTest(MailerTestCase):
     def setUp(self):
+        super().setUp()
         config = {
             "acquire.side_effect": lockfile.AlreadyLocked,
         }
@@ -480,8 +585,9 @@ class LockLockedTest(TestCase):
         self.patcher_prio.stop()
 
 
-class LockTimeoutTest(TestCase):
+class LockTimeoutTest(MailerTestCase):
     def setUp(self):
+        super().setUp()
         config = {
             "acquire.side_effect": lockfile.LockTimeout,
         }
@@ -504,7 +610,7 @@ class LockTimeoutTest(TestCase):
         self.patcher_prio.stop()
 
 
-class PrioritizeTest(TestCase):
+class PrioritizeTest(MailerTestCase):
     def test_prioritize(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
             mailer.send_mail("Subject", "Body", "prio1@example.com", ["r@example.com"], priority=PRIORITY_HIGH)
@@ -575,8 +681,41 @@ class PrioritizeTest(TestCase):
             self.assertEqual(Message.objects.count(), 1)
             self.assertEqual(Message.objects.deferred().count(), 1)
 
+    def test_prioritize_defers_message_data(self):
+        mailer.send_mail("Subject", "Body", "prio1@example.com", ["r@example.com"])
+
+        msg = engine.prioritize()[0]
+        self.assertEqual(msg.get_deferred_fields(), {"message_data", "message_data_bin"})
+
+        # a queryset passed in isn't evaluated before the message data is deferred
+        with self.assertNumQueries(0):
+            queryset = engine.prioritize(Message.objects.all())
+        self.assertEqual(queryset.get().get_deferred_fields(), msg.get_deferred_fields())
+        self.assertEqual(list(engine.prioritize(Message.objects.none())), [])
+
+    def test_lock_next(self):
+        mailer.send_mail("Subject", "Body", "prio1@example.com", ["r@example.com"], priority=PRIORITY_LOW)
+        mailer.send_mail("Subject", "Body", "prio2@example.com", ["r@example.com"], priority=PRIORITY_HIGH)
+        mailer.send_mail("Subject", "Body", "prio3@example.com", ["r@example.com"], priority=PRIORITY_DEFERRED)
+        mailer.send_mail("Subject", "Body", "prio4@example.com", ["r@example.com"], priority=PRIORITY_HIGH)
+
+        with transaction.atomic():
+            messages = Message.objects.lock_next(batch=2)
+            self.assertEqual([m.email.from_email for m in messages], ["prio2@example.com", "prio4@example.com"])
+
+            messages = Message.objects.lock_next()
+            self.assertEqual(
+                [m.email.from_email for m in messages], ["prio2@example.com", "prio4@example.com", "prio1@example.com"]
+            )
+
+        # SQLite ignores row locks, so check the query asks for them
+        query = Message.objects._lock_next_queryset().query
+        self.assertTrue(query.select_for_update)
+        self.assertTrue(query.select_for_update_skip_locked)
+        self.assertFalse(query.select_for_update_nowait)
+
 
-class MessagesTest(TestCase):
+class MessagesTest(MailerTestCase):
     def test_message(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
             mailer.send_mail("Subject Msg", "Body", "msg1@example.com", ["rec1@example.com"])
@@ -592,6 +731,7 @@ class MessagesTest(TestCase):
             self.assertEqual(msg.subject, "Subject Msg")
 
             # Fake a msg stored in DB with invalid data
+            msg.message_data_bin = None
             msg.message_data = ""
 
             self.assertEqual(msg.to_addresses, [])
@@ -611,6 +751,37 @@ class MessagesTest(TestCase):
             # Delivery should discard broken messages
             self.assertEqual(MessageLog.objects.count(), 0)
 
+    def test_message_data_bin(self):
+        mailer.send_mail("Subject Msg", "Body", "msg1@example.com", ["rec1@example.com"])
+
+        msg = Message.objects.get()
+        self.assertEqual(msg.message_data, "")
+        self.assertEqual(pickle.loads(msg.message_data_bin).subject, "Subject Msg")
+
+        # Rows stored before message_data_bin existed are still readable
+        email = msg.email
+        Message.objects.filter(pk=msg.pk).update(
+            message_data_bin=None, message_data=base64.encodebytes(pickle.dumps(email)).decode("ascii")
+        )
+        msg = Message.objects.get()
+        self.assertEqual(msg.subject, "Subject Msg")
+        self.assertEqual(msg.to_addresses, ["rec1@example.com"])
+
+    def test_message_email_cached(self):
+        mailer.send_mail("Subject Msg", "Body", "msg1@example.com", ["rec1@example.com"])
+        msg = Message.objects.get()
+
+        with patch("mailer.models.db_to_email", wraps=db_to_email) as db_to_email_mock:
+            str(msg)
+            self.assertEqual(msg.to_addresses, ["rec1@example.com"])
+            self.assertEqual(msg.subject, "Subject Msg")
+            self.assertEqual(db_to_email_mock.call_count, 1)
+
+            msg.email = mail.EmailMessage("New subject", "Body", "msg1@example.com", ["rec2@example.com"])
+            self.assertEqual(msg.subject, "New subject")
+            self.assertEqual(msg.to_addresses, ["rec2@example.com"])
+            self.assertEqual(db_to_email_mock.call_count, 2)
+
     def test_message_log(self):
         with self.settings(MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
             mailer.send_mail("Subject Log", "Body", "log1@example.com", ["1gol@example.com"])
@@ -632,11 +803,24 @@ class MessagesTest(TestCase):
             self.assertEqual(log.subject, "Subject Log")
 
             # Fake a log entry without email
+            log.message_data_bin = None
             log.message_data = ""
 
             self.assertEqual(log.to_addresses, None)
             self.assertEqual(log.subject, None)
 
+    def test_message_log_bulk(self):
+        for i in range(3):
+            mailer.send_mail(f"Subject {i}", "Body", "log1@example.com", ["1gol@example.com"])
+        messages = list(Message.objects.order_by("pk"))
+
+        MessageLog.objects.log_bulk([(message, RESULT_SUCCESS, "") for message in messages])
+
+        self.assertEqual(
+            sorted(log.subject for log in MessageLog.objects.filter(result=RESULT_SUCCESS)),
+            ["Subject 0", "Subject 1", "Subject 2"],
+        )
+
     def test_message_log_without_log_message_data(self):
         with self.settings(
             MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
@@ -659,6 +843,7 @@ class MessagesTest(TestCase):
 
             self.assertEqual(log.email, None)
             self.assertEqual(log.message_data, None)
+            self.assertEqual(log.message_data_bin, None)
             self.assertEqual(log.to_addresses, None)
             self.assertEqual(log.subject, None)
             self.assertEqual(log.when_added, when_added)
@@ -674,6 +859,7 @@ class MessagesTest(TestCase):
                 str(msg),
                 f'On {msg.when_added}, "Subject Msg 中" to rec1@example.com',
             )
+            msg.message_data_bin = None
             msg.message_data = None
             self.assertEqual(str(msg), "<Message repr unavailable>")
 
@@ -694,11 +880,24 @@ class MessagesTest(TestCase):
                 log_mock.side_effect = ValueError
                 self.assertEqual(str(log), "<MessageLog repr unavailable>")
 
+            log.message_data_bin = None
             log.message_data = None
             self.assertEqual(str(log), f'On {log.when_attempted}, "{log.message_id}"')
 
 
-class DbToEmailTest(TestCase):
+class GetMessageIdTest(MailerTestCase):
+    def test_get_message_id(self):
+        email = mail.EmailMessage("Subject", "Body", "sender@example.com", ["rec@example.com"])
+        self.assertIsNone(get_message_id(email))
+
+        email.extra_headers["Message-ID"] = "<1@example.com>"
+        self.assertEqual(get_message_id(email), "<1@example.com>")
+
+        email.extra_headers = {"message-id": "<2@example.com>"}
+        self.assertEqual(get_message_id(email), "<2@example.com>")
+
+
+class DbToEmailTest(MailerTestCase):
     def test_db_to_email(self):
         # Empty/Invalid content
         self.assertEqual(db_to_email(""), None)
@@ -726,6 +925,19 @@ class DbToEmailTest(TestCase):
         self.assertEqual(converted_email.from_email, email.from_email)
         self.assertEqual(converted_email.to, email.to)
 
+        # Test base64 encoded pickle in DB format, and the first format in a TextField
+        old_formats = [base64.encodebytes(pickle.dumps(email)).decode("ascii"), pickle.dumps(email, 0).decode("ascii")]
+        for db_email in old_formats:
+            converted_email = db_to_email(db_email)
+            self.assertEqual(converted_email.subject, email.subject)
+            self.assertEqual(converted_email.to, email.to)
+
+        # Memoryview, as returned for a BinaryField by some databases
+        self.assertEqual(db_to_email(memoryview(email_to_db(email))).subject, email.subject)
+
+        self.assertEqual(db_to_email("not a pickle"), None)
+        self.assertEqual(db_to_email(b"not a pickle."), None)
+
 
 def call_command_with_cron_arg(command, cron_value):
     # for old django versions, `call_command` doesn't parse arguments
@@ -737,7 +949,7 @@ def call_command_with_cron_arg(command, cron_value):
     return call_command(command, f"--cron={cron_value}")
 
 
-class CommandHelperTest(TestCase):
+class CommandHelperTest(MailerTestCase):
     def test_send_mail_no_cron(self):
         call_command("send_mail")
 
@@ -777,6 +989,69 @@ class CommandHelperTest(TestCase):
             self.assertEqual(Message.objects.count(), 0)
             self.assertEqual(Message.objects.deferred().count(), 0)
 
+    def test_purge_deferred_in_batches(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend", MAILER_PURGE_BATCH_SIZE=2):
+            mailer.send_mail("Subject1", "Body1", "sender1@example.com", ["recipient1@example.com"])
+            mailer.send_mail("Subject2", "Body2", "sender2@example.com", ["recipient2@example.com"])
+            mailer.send_mail("Subject3", "Body3", "sender3@example.com", ["recipient3@example.com"])
+            mailer.send_mail("Subject4", "Body4", "sender4@example.com", ["recipient4@example.com"])
+
+            engine.send_all()
+            mailer.send_mail("Subject5", "Body5", "sender5@example.com", ["recipient5@example.com"])
+
+            self.assertEqual(Message.objects.deferred().count(), 4)
+
+            count = Message.objects.purge_deferred()
+
+            self.assertEqual(count, 4)
+            self.assertEqual(Message.objects.deferred().count(), 0)
+            self.assertEqual(Message.objects.non_deferred().count(), 1)
+
+    def test_purge_deferred_skips_rows_changed_between_batches(self):
+        with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend", MAILER_PURGE_BATCH_SIZE=2):
+            for i in range(4):
+                mailer.send_mail(f"Subject{i}", "Body", "sender@example.com", ["recipient@example.com"])
+            engine.send_all()
+            self.assertEqual(Message.objects.deferred().count(), 4)
+
+            chunked_pks = mailer.models._chunked_pks
+
+            def retry_during_purge(qs, chunk):
+                for n, ids in enumerate(chunked_pks(qs, chunk)):
+                    if n == 1:
+                        # retried after its key was read, but before the DELETE
+                        Message.objects.filter(pk=ids[0]).update(priority=PRIORITY_MEDIUM)
+                    yield ids
+
+            with patch("mailer.models._chunked_pks", side_effect=retry_during_purge):
+                self.assertEqual(Message.objects.purge_deferred(), 3)
+
+            self.assertEqual(Message.objects.deferred().count(), 0)
+            self.assertEqual(Message.objects.non_deferred().count(), 1)
+
+    def test_purge_deferred_sends_delete_signals(self):
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.pk)
+
+        with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend"):
+            mailer.send_mail("Subject1", "Body1", "sender1@example.com", ["recipient1@example.com"])
+            mailer.send_mail("Subject2", "Body2", "sender2@example.com", ["recipient2@example.com"])
+
+            engine.send_all()
+
+            pks = sorted(Message.objects.values_list("pk", flat=True))
+            post_delete.connect(receiver, sender=Message)
+            try:
+                count = Message.objects.purge_deferred()
+            finally:
+                post_delete.disconnect(receiver, sender=Message)
+
+            self.assertEqual(count, 2)
+            self.assertEqual(sorted(deleted), pks)
+            self.assertEqual(Message.objects.count(), 0)
+
     def test_purge_deferred_command(self):
         with self.settings(MAILER_EMAIL_BACKEND="tests.FailingMailerEmailBackend"):
             mailer.send_mail("Subject1", "Body1", "sender1@example.com", ["recipient1@example.com"])
@@ -804,7 +1079,7 @@ class CommandHelperTest(TestCase):
         call_command_with_cron_arg("purge_deferred", 1)
 
 
-class EmailBackendSettingLoopTest(TestCase):
+class EmailBackendSettingLoopTest(MailerTestCase):
     def test_loop_detection(self):
         with self.settings(
             EMAIL_BACKEND="mailer.backend.DbBackend", MAILER_EMAIL_BACKEND="mailer.backend.DbBackend"
@@ -816,10 +1091,11 @@ class EmailBackendSettingLoopTest(TestCase):
         self.assertIn("MAILER_EMAIL_BACKEND", str(catcher.exception))
 
 
-class UseFileLockTest(TestCase):
+class UseFileLockTest(MailerTestCase):
     """Test the MAILER_USE_FILE_LOCK setting."""
 
     def setUp(self):
+        super().setUp()
         # mocking return_value to prevent "ValueError: not enough values to unpack"
         self.patcher_acquire_lock = patch("mailer.engine.acquire_lock", return_value=(True, True))
         self.patcher_release_lock = patch("mailer.engine.release_lock", return_value=(True, True))